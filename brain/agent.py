@@ -1,17 +1,21 @@
 import os
+import re
 import base64
-from io import BytesIO
+import hashlib
+import threading
+from collections import OrderedDict
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from langchain_huggingface import HuggingFaceEndpoint
 from langchain.chains import LLMChain
 from langchain_core.prompts import PromptTemplate
-from langgraph.checkpoint.memory import MemorySaver
-from langgraph.graph import START, MessagesState, StateGraph
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
-from typing import TypedDict
-from PIL import Image
+from typing import Optional, TypedDict
+import cv2
 from dotenv import load_dotenv
 import numpy as np
+import orjson
 
 load_dotenv()
 
@@ -23,25 +27,21 @@ os.environ["HUGGINGFACEHUB_API_TOKEN"] = HUGGINGFACEHUB_API_TOKEN
 endpoint_url = os.getenv('endpoint_url')
 
 
-def convert_numpy_types(obj):
-    """Recursively convert numpy types to native Python types"""
-    if isinstance(obj, dict):
-        return {key: convert_numpy_types(value) for key, value in obj.items()}
-    elif isinstance(obj, list):
-        return [convert_numpy_types(item) for item in obj]
-    elif isinstance(obj, np.integer):
-        return int(obj)
-    elif isinstance(obj, np.floating):
-        return float(obj)
-    elif isinstance(obj, np.ndarray):
-        return obj.tolist()
-    else:
-        return obj
+# Columns of the emotion output that are shown to the model
+PROMPT_PEOPLE_FIELDS = ("emotions", "confidences", "bboxes")
+
+def people_to_json(people):
+    """Serialize the per-person emotion columns for the prompt (numpy handled natively by orjson)"""
+    if not people:
+        return "{}"
+    fields = {field: people[field] for field in PROMPT_PEOPLE_FIELDS if field in people}
+    return orjson.dumps(fields, option=orjson.OPT_SERIALIZE_NUMPY).decode()
 
 class HarmonyState(TypedDict):
     messages: list
     image_path: str  # Store path instead of PIL Image to avoid serialization issues
-    people: dict
+    frame: Optional[np.ndarray]  # In-memory BGR capture; used instead of image_path when set
+    people_json: str  # Pre-serialized emotion columns
 
 sys_msg = """
 You are HarmonyBot, an emotion-aware social robot designed for conflict mediation. You are a wise, empathetic and friendly robot.
@@ -55,7 +55,7 @@ template = """
 HarmonyBot emotion-aware social robot for conflict mediation, This is the current situation of conflict.
 Inputs:
 - Conversation: {conversation}
-- People Emotion Labels with Face Coordinates: {people}
+- People Emotion Labels with Face Coordinates (one entry per person; bboxes are [x, y, w, h]): {people_json}
 You also receive a user image (provided separately). Detect the emotions and reasons in conversation and image and
 respond in a helpful and emotionally aware manner with gentle prompts, tone shifts, humor, or empathy to de-escalate tension and promote calm communication between people. Provide short and humanize output.
 Don't use Person1, Person2 in output. People will feel awkward. Use a special characteristic you identified in each person.
@@ -63,12 +63,63 @@ Don't use Person1, Person2 in output. People will feel awkward. Use a special ch
 
 prompt = PromptTemplate.from_template(template)
 
-def image_to_base64(image: Image.Image) -> str:
-    """Convert PIL Image to base64 string"""
-    buffered = BytesIO()
-    image.save(buffered, format="JPEG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-    return img_str
+# Completions keyed by SHA-256 of (pixels + prompt), oldest evicted first
+RESPONSE_CACHE_SIZE = 128
+_response_cache = OrderedDict()
+
+# Encoded frames keyed by (image_path, mtime) so an unchanged file is not re-encoded
+B64_CACHE_SIZE = 8
+_b64_cache: dict[tuple[str, float], tuple[str, bytes]] = {}
+
+def cache_key(pixel_digest: bytes, prompt_text: str) -> str:
+    """Content hash of decoded pixels and prompt text"""
+    return hashlib.sha256(pixel_digest + prompt_text.encode()).hexdigest()
+
+def get_cached_response(key):
+    """Return cached completion for key (marking it recently used) or None"""
+    if key not in _response_cache:
+        return None
+    _response_cache.move_to_end(key)
+    return _response_cache[key]
+
+def store_cached_response(key, content):
+    """Store completion and evict least recently used entries over the cap"""
+    _response_cache[key] = content
+    _response_cache.move_to_end(key)
+    while len(_response_cache) > RESPONSE_CACHE_SIZE:
+        _response_cache.popitem(last=False)
+
+# Longest edge sent to the vision model (typical vision tower resolution)
+VISION_MAX_EDGE = 384
+
+def frame_to_b64(frame: np.ndarray) -> str:
+    """Encode a BGR frame as a downscaled, compact base64 JPEG with OpenCV (libjpeg-turbo)"""
+    height, width = frame.shape[:2]
+    scale = VISION_MAX_EDGE / max(height, width)
+    if scale < 1:
+        frame = cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+    ok, buf = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 70, cv2.IMWRITE_JPEG_OPTIMIZE, 1])
+    if not ok:
+        raise ValueError("Could not encode frame as JPEG")
+    return base64.b64encode(buf).decode()
+
+def frame_digest(frame: np.ndarray) -> bytes:
+    """SHA-256 of the raw pixel bytes"""
+    return hashlib.sha256(np.ascontiguousarray(frame).tobytes()).digest()
+
+def load_image_b64(image_path):
+    """Return (base64 JPEG, pixel digest) for image_path, reusing the last encode if the file is unchanged"""
+    key = (image_path, os.path.getmtime(image_path))
+    entry = _b64_cache.get(key)
+    if entry is None:
+        frame = cv2.imread(image_path)
+        if frame is None:
+            raise FileNotFoundError(f"No image found at {image_path}")
+        entry = (frame_to_b64(frame), frame_digest(frame))
+        _b64_cache[key] = entry
+        while len(_b64_cache) > B64_CACHE_SIZE:
+            _b64_cache.pop(next(iter(_b64_cache)))
+    return entry
 
 class VisionHuggingFaceEndpoint:
     """Custom vision model endpoint that mimics HuggingFaceEndpoint interface"""
@@ -80,17 +131,28 @@ class VisionHuggingFaceEndpoint:
         self.top_k = kwargs.get('top_k', 25)
         self.top_p = kwargs.get('top_p', 0.95)
         self.repetition_penalty = kwargs.get('repetition_penalty', 1.03)
-    
-    def invoke(self, prompt_text, image_path=None):
-        """Invoke the vision model with text and image"""
-        try:
-            # Load and convert image to base64
-            image = Image.open(image_path).convert("RGB")
-            image_b64 = image_to_base64(image)
-        except Exception as e:
-            return f"Error loading image: {str(e)}"
         
-        # OpenAI-compatible payload with vision
+        # One keep-alive session for every call: skips TCP + TLS setup after the first request
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Bearer {HUGGINGFACEHUB_API_TOKEN}",
+            "Content-Type": "application/json",
+            "X-use-cache": "true"  # Let HuggingFace serve repeated requests from its inference cache
+        })
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                              max_retries=Retry(total=2, backoff_factor=0.2))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+    
+    def _encode_image(self, image_path=None, frame=None):
+        """Return (base64 JPEG, pixel digest) from an in-memory frame or an image file"""
+        if frame is not None:
+            return frame_to_b64(frame), frame_digest(frame)
+        # File fallback: load and convert image to base64 (cached per file modification)
+        return load_image_b64(image_path)
+    
+    def _build_payload(self, prompt_text, image_b64, stream=False):
+        """OpenAI-compatible payload with vision"""
         payload = {
             "messages": [
                 {
@@ -104,24 +166,42 @@ class VisionHuggingFaceEndpoint:
             "max_tokens": self.max_new_tokens,
             "temperature": self.temperature
         }
+        if stream:
+            payload["stream"] = True
+        return payload
+    
+    def invoke(self, prompt_text, image_path=None, frame=None):
+        """Invoke the vision model with text and image
         
-        headers = {
-            "Authorization": f"Bearer {HUGGINGFACEHUB_API_TOKEN}",
-            "Content-Type": "application/json"
-        }
+        An in-memory BGR frame (e.g. camera_manager.get_frame()) is encoded
+        directly; image_path is only read when no frame is given.
+        """
+        try:
+            image_b64, pixel_digest = self._encode_image(image_path, frame)
+        except Exception as e:
+            return f"Error loading image: {str(e)}"
+        
+        # Same frame + same prompt -> skip the HTTP round trip
+        key = cache_key(pixel_digest, prompt_text)
+        cached = get_cached_response(key)
+        if cached is not None:
+            return cached
+        
+        payload = self._build_payload(prompt_text, image_b64)
         
         try:
-            response = requests.post(self.endpoint_url, 
-                                   headers=headers, 
-                                   json=payload,
-                                   timeout=15)
+            response = self.session.post(self.endpoint_url, 
+                                         json=payload,
+                                         timeout=15)
             
             response.raise_for_status()
             result = response.json()
             
             # Extract response from OpenAI format
             if "choices" in result and len(result["choices"]) > 0:
-                return result["choices"][0]["message"]["content"]
+                content = result["choices"][0]["message"]["content"]
+                store_cached_response(key, content)
+                return content
             else:
                 return f"Unexpected response format: {result}"
                 
@@ -129,6 +209,59 @@ class VisionHuggingFaceEndpoint:
             return f"API request failed: {str(e)}"
         except Exception as e:
             return f"Error processing response: {str(e)}"
+    
+    def stream(self, prompt_text, image_path=None, frame=None):
+        """Yield the completion in chunks as the server generates them (SSE)
+        
+        Lets a consumer such as TTS start on the first sentence instead of
+        waiting for the last token. Errors are yielded as text, like invoke().
+        """
+        try:
+            image_b64, pixel_digest = self._encode_image(image_path, frame)
+        except Exception as e:
+            yield f"Error loading image: {str(e)}"
+            return
+        
+        key = cache_key(pixel_digest, prompt_text)
+        cached = get_cached_response(key)
+        if cached is not None:
+            yield cached
+            return
+        
+        payload = self._build_payload(prompt_text, image_b64, stream=True)
+        parts = []
+        
+        try:
+            with self.session.post(self.endpoint_url,
+                                   json=payload,
+                                   stream=True,
+                                   timeout=15) as response:
+                response.raise_for_status()
+                
+                for line in response.iter_lines():
+                    if not line.startswith(b"data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == b"[DONE]":
+                        break
+                    
+                    choices = orjson.loads(data).get("choices")
+                    if not choices:
+                        continue
+                    content = choices[0].get("delta", {}).get("content") or ""
+                    if content:
+                        parts.append(content)
+                        yield content
+                        
+        except requests.exceptions.RequestException as e:
+            yield f"API request failed: {str(e)}"
+            return
+        except Exception as e:
+            yield f"Error processing response: {str(e)}"
+            return
+        
+        if parts:
+            store_cached_response(key, "".join(parts))
 
 # Use the custom vision model instead of regular HuggingFaceEndpoint
 model = VisionHuggingFaceEndpoint(
@@ -141,40 +274,70 @@ model = VisionHuggingFaceEndpoint(
     repetition_penalty=1.03,
 )
 
+def prewarm_llm_connection():
+    """Open the pooled connection to the vision endpoint before the real request is sent"""
+    try:
+        model.session.head(endpoint_url, timeout=2)
+        return True
+    except Exception:
+        return False
+
+# Static start of every formatted prompt, shared by all turns
+PROMPT_PREFIX = template.split("{conversation}")[0]
+
+def prime_prompt_prefix():
+    """Send the static prompt prefix with max_tokens=1 so the server can prefix-cache it
+    
+    The real request starts with the same tokens, so its prefill for them is
+    skipped; this also opens the pooled connection.
+    """
+    try:
+        model.session.post(endpoint_url,
+                           json={
+                               "messages": [{"role": "user", "content": [{"type": "text", "text": PROMPT_PREFIX}]}],
+                               "max_tokens": 1
+                           },
+                           timeout=5)
+        return True
+    except Exception:
+        return False
+
 def call_model(state: HarmonyState) -> dict:
     image_path = state["image_path"]  # Get image path instead of PIL Image
     conversation = "\n".join([msg.content for msg in state["messages"] if isinstance(msg, HumanMessage)])
     prompt_text = prompt.format(
         conversation=conversation,
-        people=str(state["people"]),
+        people_json=state["people_json"],
     )
     
-    # Use custom vision model that accepts image_path
-    response = model.invoke(prompt_text, image_path=image_path)
+    # Use custom vision model that accepts image_path (or the in-memory frame)
+    frame = state.get("frame")
+    if frame is not None:
+        response = model.invoke(prompt_text, frame=frame)
+    else:
+        response = model.invoke(prompt_text, image_path=image_path)
     
     return {
         "messages": state["messages"] + [AIMessage(content=response)],
         "image_path": image_path,  # Keep as path
-        "people": state["people"],
+        "frame": frame,
+        "people_json": state["people_json"],
     }
 
-workflow = StateGraph(state_schema=HarmonyState)
-workflow.add_node("model", call_model)
-workflow.set_entry_point("model")
-workflow.set_finish_point("model")
+# Pay TLS setup at startup instead of on the first user request
+threading.Thread(target=prewarm_llm_connection, daemon=True).start()
 
-memory = MemorySaver()
-app = workflow.compile(checkpointer=memory)
-
-def output_of_model(conversation, people):
-    # Convert numpy types to native Python types before using in state
-    people_converted = convert_numpy_types(people)
+def output_of_model(conversation, people, frame=None):
+    """Generate the robot's reply; frame is the BGR capture the emotions were computed on
+    (encoded in memory), otherwise output_image.jpg is read"""
+    # Serialize numpy columns once, straight to the JSON used in the prompt
+    people_json = people_to_json(people)
     
     # Store image path instead of loading PIL Image into state
     image_path = "output_image.jpg"
     
     # Check if image exists
-    if not os.path.exists(image_path):
+    if frame is None and not os.path.exists(image_path):
         error_msg = f"Error: {image_path} not found. Please ensure the image file exists."
         print(error_msg)
         return error_msg
@@ -185,12 +348,13 @@ def output_of_model(conversation, people):
             HumanMessage(content=conversation)
         ],
         "image_path": image_path,  # Store path instead of PIL Image
-        "people": people_converted  # Use converted data
+        "frame": frame,
+        "people_json": people_json  # Already serialized
     }
     
     try:
-        config = {"configurable": {"thread_id": "session-1"}}
-        result = app.invoke(initial_state, config=config)
+        # call_model is the only step, so it is called directly rather than through a one-node graph
+        result = call_model(initial_state)
         
         print(result["messages"][-1].content)
         return result["messages"][-1].content
@@ -198,5 +362,38 @@ def output_of_model(conversation, people):
         print(f"Oops, something went wrong: {str(e)}")
         return f"Oops, something went wrong: {str(e)}"
 
+# A sentence ends at . ! or ? followed by whitespace
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
 
-
+def stream_output_of_model(conversation, people, frame=None):
+    """Like output_of_model, but yield the response one sentence at a time as it streams
+    in, so speech can start on the first sentence instead of the last token"""
+    people_json = people_to_json(people)
+    image_path = "output_image.jpg"
+    
+    if frame is None and not os.path.exists(image_path):
+        error_msg = f"Error: {image_path} not found. Please ensure the image file exists."
+        print(error_msg)
+        yield error_msg
+        return
+    
+    prompt_text = prompt.format(conversation=conversation, people_json=people_json)
+    if frame is not None:
+        chunks = model.stream(prompt_text, frame=frame)
+    else:
+        chunks = model.stream(prompt_text, image_path=image_path)
+    
+    pending = ""
+    spoken = []
+    for chunk in chunks:
+        pending += chunk
+        *sentences, pending = SENTENCE_END.split(pending)
+        for sentence in sentences:
+            if sentence.strip():
+                spoken.append(sentence.strip())
+                yield sentence.strip()
+    if pending.strip():
+        spoken.append(pending.strip())
+        yield pending.strip()
+    
+    print(" ".join(spoken))
@@ -1,38 +1,10 @@
-import threading
 from emotion import get_emotions_with_positions
 from sentiment import text_sentiment, setup_data
 
-# Containers to store results
-emotion_result = {}
-sentiment_result = {}
+def run_face_emotion(image):
+    """Face emotions with positions for the (filtered) image, a path or BGR array; blocking, run it in a thread."""
+    return get_emotions_with_positions(image)
 
-def analyze_emotions(image_path):
-    global emotion_result
-    emotion_result = get_emotions_with_positions(image_path)
-
-def analyze_sentiment(text):
-    global sentiment_result
-    sentiment_data = setup_data(text)
-    sentiment_result['value'] = text_sentiment(sentiment_data)
-
-def run_parallel_analysis(image_path, text):
-    """Run emotion and sentiment analysis in parallel threads."""
-    global emotion_result, sentiment_result
-
-    # Reset results
-    emotion_result = {}
-    sentiment_result = {}
-
-    # Define threads
-    emotion_thread = threading.Thread(target=analyze_emotions, args=(image_path,))
-    sentiment_thread = threading.Thread(target=analyze_sentiment, args=(text,))
-
-    # Start both
-    emotion_thread.start()
-    sentiment_thread.start()
-
-    # Wait for both to finish
-    emotion_thread.join()
-    sentiment_thread.join()
-
-    return emotion_result, sentiment_result.get('value')
+async def run_text_sentiment(text):
+    """Sentiment of the captured text; needs no image, so it can start right after capture."""
+    return await text_sentiment(setup_data(text))
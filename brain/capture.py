@@ -1,6 +1,3 @@
-import threading
-from queue import Queue
-from stt import speak_to_microphone
 from camera_manager import camera_manager  # Import the shared camera manager
 
 def capture_image(output_file):
@@ -11,19 +8,9 @@ def capture_image(output_file):
         print("Failed to capture image from shared camera")
     return success
 
-def capture_both_simultaneously():
-    """MODIFIED - Uses shared camera manager"""
-    text_queue = Queue()
-    # Create threads
-    image_thread = threading.Thread(target=capture_image, args=("output_image.jpg",))
-    speech_thread = threading.Thread(target=speak_to_microphone, args=(text_queue,))
-    # Start threads
-    image_thread.start()
-    speech_thread.start()
-    # Wait for both
-    image_thread.join()
-    speech_thread.join()
-    # Get the spoken text
-    spoken_text = text_queue.get()
-    print('step 1')
-    return spoken_text
\ No newline at end of file
+def capture_frame():
+    """Return a copy of the current frame as a BGR array (None if the camera has none yet)"""
+    frame = camera_manager.get_frame(copy=True)
+    if frame is None:
+        print("Failed to capture image from shared camera")
+    return frame
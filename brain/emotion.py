@@ -1,25 +1,398 @@
 from deepface import DeepFace
+import cv2
+import numpy as np
 import os
+import statistics
+import time
+import tensorflow as tf
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
 #detector_backend='retinaface' - previously
 
-def get_emotions_by_deepface(img_path):
+# Fast path: YuNet face detection + int8 FER+ emotion classifier through ONNX Runtime.
+# DeepFace/RetinaFace is used when onnxruntime or the model files are not available.
+YUNET_MODEL = os.getenv('YUNET_MODEL', 'face_detection_yunet_2023mar.onnx')
+EMOTION_ONNX_MODEL = os.getenv('EMOTION_ONNX_MODEL', 'emotion-ferplus-12-int8.onnx')
+
+# Optional INT8 TFLite export of the DeepFace emotion CNN (see export_emotion_tflite)
+EMOTION_TFLITE_MODEL = os.getenv('EMOTION_TFLITE_MODEL', 'emotion_int8.tflite')
+
+# FER+ output order, mapped onto DeepFace labels (contempt is folded into disgust)
+FERPLUS_LABELS = ['neutral', 'happy', 'surprise', 'sad', 'angry', 'disgust', 'fear', 'disgust']
+FERPLUS_INPUT_SIZE = 64
+
+# Emotion severity rank used to pick the most dominant emotion in a scene
+EMOTION_RANK = {"neutral": 0, "happy": 1, "surprise": 2, "disgust": 3, "sad": 4, "fear": 5, "angry": 6}
+RANK_TO_EMOTION = {rank: emotion for emotion, rank in EMOTION_RANK.items()}
+NEGATIVE_EMOTIONS = frozenset({'angry', 'fear', 'sad', 'disgust'})
+
+# DeepFace emotion CNN output order and input size
+DEEPFACE_EMOTION_LABELS = ['angry', 'disgust', 'fear', 'happy', 'sad', 'surprise', 'neutral']
+DEEPFACE_INPUT_SIZE = 48
+
+# GPU memory reserved for TensorFlow (MB)
+TF_GPU_MEMORY_LIMIT_MB = int(os.getenv('TF_GPU_MEMORY_LIMIT_MB', '1536'))
+
+# Set GPU_XLA_DISABLE=1 to run the emotion CNN without XLA
+XLA_ENABLED = not os.getenv('GPU_XLA_DISABLE')
+
+# Set EMOTION_MIXED_PRECISION=1 to run the emotion CNN in mixed_float16 on GPU;
+# off by default, check compare_mixed_precision() on real crops first
+MIXED_PRECISION_ENABLED = os.getenv('EMOTION_MIXED_PRECISION') == '1'
+
+# Face batches are padded up to one of these sizes so XLA compiles a fixed set of shapes
+EMOTION_BATCH_BUCKETS = (1, 4, 16)
+
+def load_onnx_models():
+    """Create the YuNet detector and emotion session once, or (None, None) if unavailable
+    
+    Both run on CUDA when OpenCV / onnxruntime were built with it, otherwise on CPU.
+    """
+    if ort is None or not (os.path.exists(YUNET_MODEL) and os.path.exists(EMOTION_ONNX_MODEL)):
+        return None, None
+
+    if cv2.cuda.getCudaEnabledDeviceCount() > 0:
+        backend_id, target_id = cv2.dnn.DNN_BACKEND_CUDA, cv2.dnn.DNN_TARGET_CUDA_FP16
+    else:
+        backend_id, target_id = cv2.dnn.DNN_BACKEND_DEFAULT, cv2.dnn.DNN_TARGET_CPU
+    detector = cv2.FaceDetectorYN.create(YUNET_MODEL, "", (640, 480),
+                                         backend_id=backend_id, target_id=target_id)
+
+    providers = ["CPUExecutionProvider"]
+    if "CUDAExecutionProvider" in ort.get_available_providers():
+        providers.insert(0, ("CUDAExecutionProvider", {"device_id": 0}))
+    session = ort.InferenceSession(EMOTION_ONNX_MODEL, providers=providers)
+    return detector, session
+
+def configure_gpu():
+    """Configure TensorFlow for the emotion CNN (no-op without a GPU)"""
+    gpus = tf.config.list_physical_devices('GPU')
+    if not gpus:
+        return
+
+    # Fixed cap instead of memory growth: growth fragments and can end up holding more,
+    # and a known cap leaves the rest of the card predictably to YOLO's torch allocator
+    tf.config.set_logical_device_configuration(
+        gpus[0], [tf.config.LogicalDeviceConfiguration(memory_limit=TF_GPU_MEMORY_LIMIT_MB)])
+
+    # TF32 matmuls on Ampere+ tensor cores; FP16 is opt-in per model (see to_mixed_precision)
+    try:
+        tf.config.experimental.enable_tensor_float_32_execution(True)
+    except Exception as e:
+        print(f"TF32 unavailable: {e}")
+
+    # XLA auto-clustering can regress on some ops; skipped when GPU_XLA_DISABLE is set
+    if XLA_ENABLED:
+        try:
+            tf.config.optimizer.set_jit("autoclustering")
+        except Exception as e:
+            print(f"XLA auto-clustering unavailable: {e}")
+
+def build_emotion_model():
+    """Build DeepFace's emotion CNN once and return the underlying Keras model"""
+    try:
+        client = DeepFace.build_model(task="facial_attribute", model_name="Emotion")
+    except TypeError:
+        # Older DeepFace releases take the model name only
+        client = DeepFace.build_model("Emotion")
+    return getattr(client, "model", client)
+
+def _mixed_precision_layer(layer):
+    config = layer.get_config()
+    if not isinstance(layer, tf.keras.layers.InputLayer):
+        config['dtype'] = 'mixed_float16'
+    return layer.__class__.from_config(config)
+
+def to_mixed_precision(model):
+    """Copy of model with mixed_float16 layers (FP16 compute, FP32 weights)
+    
+    Only this copy changes; the global policy, and with it RetinaFace and
+    the original model, stays float32.
+    """
+    mixed = tf.keras.models.clone_model(model, clone_function=_mixed_precision_layer)
+    mixed.set_weights(model.get_weights())
+    return mixed
+
+def load_emotion_model():
+    """Build the emotion CNN, in mixed_float16 when EMOTION_MIXED_PRECISION=1 and a GPU is present"""
+    model = build_emotion_model()
+    if MIXED_PRECISION_ENABLED and tf.config.list_physical_devices('GPU'):
+        try:
+            model = to_mixed_precision(model)
+        except Exception as e:
+            print(f"Mixed precision unavailable, staying on float32: {e}")
+    return model
+
+def compare_mixed_precision(face_crops, tolerance=0.05):
+    """Compare float32 and mixed_float16 emotion CNN outputs before enabling EMOTION_MIXED_PRECISION
+    
+    face_crops: a few dozen grayscale crops shaped (48, 48, 1), scaled to [0, 1].
+    Returns (max probability difference, fraction of crops with the same top emotion).
+    """
+    batch = np.stack([np.asarray(crop, dtype=np.float32) for crop in face_crops])
+    reference = build_emotion_model()
+    expected = reference(batch, training=False).numpy()
+    actual = tf.cast(to_mixed_precision(reference)(batch, training=False), tf.float32).numpy()
+
+    max_diff = float(np.max(np.abs(expected - actual)))
+    agreement = float(np.mean(expected.argmax(axis=1) == actual.argmax(axis=1)))
+    verdict = "OK" if max_diff <= tolerance and agreement == 1.0 else "MISMATCH"
+    print(f"mixed_float16 vs float32: max diff {max_diff:.4f}, top emotion agreement {agreement:.0%} ({verdict})")
+    return max_diff, agreement
+
+configure_gpu()
+
+face_detector, emotion_session = load_onnx_models()
+
+def make_emotion_forward(model):
+    """Wrap the emotion CNN forward pass in an XLA-compiled tf.function"""
+    @tf.function(jit_compile=XLA_ENABLED,
+                 input_signature=[tf.TensorSpec([None, DEEPFACE_INPUT_SIZE, DEEPFACE_INPUT_SIZE, 1], tf.float32)])
+    def forward(x):
+        return tf.cast(model(x, training=False), tf.float32)
+    return forward
+
+def export_emotion_tflite(face_crops, output_path=EMOTION_TFLITE_MODEL):
+    """Quantize the emotion CNN to INT8 TFLite, calibrated on real face crops
+    
+    face_crops: ~100 grayscale crops shaped (48, 48, 1), scaled to [0, 1].
+    Run once offline; the float32 model is quantized, and the file is picked up
+    at import on the next start.
+    """
+    model = build_emotion_model()
+
+    def representative_dataset():
+        for crop in face_crops:
+            yield [np.asarray(crop, dtype=np.float32)[np.newaxis, ...]]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    with open(output_path, 'wb') as f:
+        f.write(converter.convert())
+
+def load_emotion_interpreter():
+    """Load the INT8 TFLite emotion model if it has been exported, else None"""
+    if not os.path.exists(EMOTION_TFLITE_MODEL):
+        return None
+    interpreter = tf.lite.Interpreter(model_path=EMOTION_TFLITE_MODEL)
+    interpreter.allocate_tensors()
+    return interpreter
+
+def predict_emotions_tflite(batch):
+    """Run the INT8 TFLite emotion model on (K, 48, 48, 1) crops"""
+    input_detail = emotion_interpreter.get_input_details()[0]
+    if tuple(input_detail['shape']) != batch.shape:
+        # Only re-allocates when the number of faces changes
+        emotion_interpreter.resize_tensor_input(input_detail['index'], batch.shape)
+        emotion_interpreter.allocate_tensors()
+        input_detail = emotion_interpreter.get_input_details()[0]
+    emotion_interpreter.set_tensor(input_detail['index'], batch)
+    emotion_interpreter.invoke()
+    return emotion_interpreter.get_tensor(emotion_interpreter.get_output_details()[0]['index']).astype(np.float32)
+
+def predict_emotions(batch):
+    """Run the emotion CNN on (K, 48, 48, 1) crops (TFLite INT8 if exported, else compiled Keras)"""
+    if emotion_interpreter is not None:
+        return predict_emotions_tflite(batch)
+
+    # Pad to the batch buckets so XLA only sees a fixed set of shapes
+    outputs = []
+    max_bucket = EMOTION_BATCH_BUCKETS[-1]
+    for start in range(0, len(batch), max_bucket):
+        chunk = batch[start:start + max_bucket]
+        bucket = next(size for size in EMOTION_BATCH_BUCKETS if size >= len(chunk))
+        padded = np.zeros((bucket,) + chunk.shape[1:], dtype=np.float32)
+        padded[:len(chunk)] = chunk
+        outputs.append(emotion_forward(padded).numpy()[:len(chunk)])
+    return np.concatenate(outputs)
+
+# Only needed when the ONNX path is unavailable; built here so weights load once, not per frame
+emotion_interpreter = load_emotion_interpreter() if face_detector is None else None
+emotion_model = load_emotion_model() if face_detector is None and emotion_interpreter is None else None
+emotion_forward = make_emotion_forward(emotion_model) if emotion_model is not None else None
+
+def warm_up():
+    """Load the detector and run the emotion model once on black input before serving frames"""
+    if face_detector is not None:
+        return
+
+    # First extract_faces call loads RetinaFace weights; DeepFace caches the model afterwards
+    DeepFace.extract_faces(img_path=np.zeros((DEEPFACE_INPUT_SIZE, DEEPFACE_INPUT_SIZE, 3), dtype=np.uint8),
+                           detector_backend='retinaface', enforce_detection=False)
+
+    if emotion_forward is not None:
+        # Compile every bucket now so the first real frame does not pay for XLA
+        for size in EMOTION_BATCH_BUCKETS:
+            emotion_forward(np.zeros((size, DEEPFACE_INPUT_SIZE, DEEPFACE_INPUT_SIZE, 1), dtype=np.float32))
+    else:
+        predict_emotions(np.zeros((1, DEEPFACE_INPUT_SIZE, DEEPFACE_INPUT_SIZE, 1), dtype=np.float32))
 
-    """Get emotions using DeepFace library"""
+warm_up()
 
-    results = DeepFace.analyze(
-        img_path=img_path,
-        actions=['emotion'],
-        enforce_detection=False,
-        detector_backend='ssd',
-        silent=True
+def read_image(img_path):
+    """Read an image from disk as a BGR array (an already-loaded BGR array is returned as-is)"""
+    if isinstance(img_path, np.ndarray):
+        return img_path
+    image = cv2.imread(img_path)
+    if image is None:
+        raise FileNotFoundError(f"No image found at {img_path}")
+    return image
+
+def clip_box(x, y, w, h, width, height):
+    """Clip a face box to the image, or return None if nothing is left"""
+    x, y = max(int(x), 0), max(int(y), 0)
+    w, h = min(int(w), width - x), min(int(h), height - y)
+    if w <= 0 or h <= 0:
+        return None
+    return x, y, w, h
+
+def face_result(labels, probs, box):
+    """Build a DeepFace.analyze-shaped result from class probabilities (percent) and a face box"""
+    emotion = {}
+    for label, prob in zip(labels, probs):
+        emotion[label] = emotion.get(label, 0.0) + float(prob)
+    x, y, w, h = box
+    return {
+        "dominant_emotion": max(emotion, key=emotion.get),
+        "emotion": emotion,
+        "region": {"x": x, "y": y, "w": w, "h": h}
+    }
+
+def detect_faces_onnx(image):
+    """Detect faces with YuNet and return clipped [x, y, w, h] boxes"""
+    height, width = image.shape[:2]
+
+    face_detector.setInputSize((width, height))
+    _, faces = face_detector.detect(image)
+    if faces is None:
+        return []
+
+    boxes = []
+    for face in faces:
+        box = clip_box(*face[:4], width, height)
+        if box is not None:
+            boxes.append(box)
+    return boxes
+
+def classify_faces_onnx(image, boxes):
+    """Classify face crops with the ONNX emotion model
+    
+    Returns a list shaped like DeepFace.analyze output (dominant_emotion, emotion, region).
+    """
+    if not boxes:
+        return []
+
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    crops = [cv2.resize(gray[y:y+h, x:x+w], (FERPLUS_INPUT_SIZE, FERPLUS_INPUT_SIZE)) for x, y, w, h in boxes]
+
+    # (K, 1, 64, 64); one run for all faces when the model has a dynamic batch dimension
+    batch = np.stack(crops).astype(np.float32)[:, np.newaxis, :, :]
+    model_input = emotion_session.get_inputs()[0]
+    if model_input.shape[0] == 1:
+        scores = np.concatenate([emotion_session.run(None, {model_input.name: batch[i:i+1]})[0]
+                                 for i in range(len(batch))])
+    else:
+        scores = emotion_session.run(None, {model_input.name: batch})[0]
+
+    # Softmax to percentages, matching DeepFace's emotion scale
+    probs = np.exp(scores - scores.max(axis=1, keepdims=True))
+    probs = probs / probs.sum(axis=1, keepdims=True) * 100
+
+    return [face_result(FERPLUS_LABELS, face_probs, box) for face_probs, box in zip(probs, boxes)]
+
+def detect_faces_deepface(image):
+    """Detect faces with RetinaFace and return clipped [x, y, w, h] boxes"""
+    height, width = image.shape[:2]
+
+    faces = DeepFace.extract_faces(
+        img_path=image,
+        detector_backend='retinaface',
+        enforce_detection=False
     )
 
-    if isinstance(results, dict):
-        results = [results]
-    return results if results else []
+    boxes = []
+    for face in faces:
+        area = face.get("facial_area", {})
+        box = clip_box(area.get('x', 0), area.get('y', 0), area.get('w', 0), area.get('h', 0), width, height)
+        if box is not None:
+            boxes.append(box)
+    return boxes
+
+def classify_faces_deepface(image, boxes):
+    """Classify face crops with the pre-built emotion model
+    
+    Returns a list shaped like DeepFace.analyze output (dominant_emotion, emotion, region).
+    """
+    if not boxes:
+        return []
+
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    crops = [cv2.resize(gray[y:y+h, x:x+w], (DEEPFACE_INPUT_SIZE, DEEPFACE_INPUT_SIZE)) for x, y, w, h in boxes]
+
+    # One forward pass for all K faces: (K, 48, 48, 1) -> (K, 7)
+    batch = (np.stack(crops).astype(np.float32) / 255.0)[..., np.newaxis]
+    probs = predict_emotions(batch)
+    probs = probs * 100 / probs.sum(axis=1, keepdims=True)
+
+    return [face_result(DEEPFACE_EMOTION_LABELS, face_probs, box) for face_probs, box in zip(probs, boxes)]
+
+def detect_faces(image):
+    """Face boxes from whichever detector is loaded (YuNet, otherwise RetinaFace)"""
+    if face_detector is not None:
+        return detect_faces_onnx(image)
+    return detect_faces_deepface(image)
+
+def classify_faces(image, boxes):
+    """Emotion results for the given boxes from whichever classifier is loaded"""
+    if face_detector is not None:
+        return classify_faces_onnx(image, boxes)
+    return classify_faces_deepface(image, boxes)
+
+def analyze_faces(img_path):
+    """Detect and classify faces with the models held on this module (no per-call model setup)"""
+    image = read_image(img_path)
+    return classify_faces(image, detect_faces(image))
+
+def benchmark_performance(img_path, runs=20):
+    """Time face detection and emotion classification separately (steady state, median ms)"""
+    image = read_image(img_path)
+
+    # One untimed pass so model loading and graph tracing are not part of the numbers
+    boxes = detect_faces(image)
+    classify_faces(image, boxes)
+
+    detect_times = []
+    classify_times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        boxes = detect_faces(image)
+        detected = time.perf_counter()
+        classify_faces(image, boxes)
+        done = time.perf_counter()
+        detect_times.append((detected - start) * 1000)
+        classify_times.append((done - detected) * 1000)
+
+    backend = "YuNet + ONNX" if face_detector is not None else "RetinaFace + Keras"
+    detect_ms = statistics.median(detect_times)
+    classify_ms = statistics.median(classify_times)
+    print(f"Backend: {backend} ({len(boxes)} face(s), {runs} runs)")
+    print(f"  Detect:   {detect_ms:.1f} ms")
+    print(f"  Classify: {classify_ms:.1f} ms")
+    print(f"  Total:    {detect_ms + classify_ms:.1f} ms")
+    return {"detect_ms": detect_ms, "classify_ms": classify_ms}
+
+def get_emotions_by_deepface(img_path):
+
+    """Get emotions using the persistent detector and emotion model"""
+
+    return analyze_faces(img_path)
 
 def number_of_people(results):
     """Count number of faces detected"""
@@ -36,50 +409,38 @@ def show_results(results):
         print(f"  Dominant Emotion: {emo}")
         print(f"  All Emotions: {face['emotion']}")
 
-def get_emotions_with_positions(img_path):
-    """Get emotions with face positions using only DeepFace"""
-    results_dict = {}
+def emotions_with_positions(deepface_results):
+    """Column-per-field view of analyze results: emotions (list of labels),
+    emotion_ids (rank per EMOTION_RANK), confidences and bboxes ([x, y, w, h] per face)
+    """
+    emotions = [face['dominant_emotion'] for face in deepface_results]
+    regions = [face.get("region", {}) for face in deepface_results]
    
-    # Analyze using DeepFace
-    deepface_results = DeepFace.analyze(
-        img_path=img_path,
-        actions=['emotion'],
-        enforce_detection=False,
-        detector_backend='retinaface'
-    )
-   
-    # Normalize to list
-    if isinstance(deepface_results, dict):
-        deepface_results = [deepface_results]
-   
-    for idx, face in enumerate(deepface_results):
-        # Get DeepFace result
-        dominant_emotion = face['dominant_emotion']
-        confidence = face['emotion'][dominant_emotion]
-       
-        # Get coordinates
-        region = face.get("region", {})
-        x, y, w, h = region.get('x', 0), region.get('y', 0), region.get('w', 0), region.get('h', 0)
-       
-        # Save result with position
-        results_dict[f"Person {idx+1}"] = {
-            "emotion": dominant_emotion,
-            "confidence": confidence,
-            "x": x,
-            "y": y,
-            "w": w,
-            "h": h
-        }
+    return {
+        "emotions": emotions,
+        "emotion_ids": np.array([EMOTION_RANK[emotion] for emotion in emotions], dtype=np.int8),
+        "confidences": np.array([face['emotion'][face['dominant_emotion']] for face in deepface_results],
+                                dtype=np.float32),
+        "bboxes": np.array([[region.get('x', 0), region.get('y', 0), region.get('w', 0), region.get('h', 0)]
+                            for region in regions], dtype=np.int32).reshape(-1, 4)
+    }
+
+def get_emotions_with_positions(img_path):
+    """Get emotions with face positions (YuNet + ONNX when available, otherwise DeepFace)
+    
+    Returns one column per field, one row per person (see emotions_with_positions).
+    """
+    results_dict = emotions_with_positions(analyze_faces(img_path))
     print('step 2')
     print(results_dict)  
-    return results_dict if results_dict else {}
+    return results_dict
 
 def analyze_image_emotions(img_path):
     """Main function to analyze emotions in an image"""
     print(f"Analyzing emotions in: {img_path}")
    
-    # Get emotions using DeepFace
-    results = get_emotions_by_deepface(img_path)
+    # One read and one detection pass feed both the printed summary and the positions
+    results = analyze_faces(img_path)
    
     if not results:
         print("No faces detected in the image.")
@@ -89,31 +450,18 @@ def analyze_image_emotions(img_path):
     print("\nDetailed Results:")
     show_results(results)
    
-    # Get emotions with positions
-    emotions_with_positions = get_emotions_with_positions(img_path)
-   
-    return emotions_with_positions
+    return emotions_with_positions(results)
 
 def most_dominant_emotion(result_dict):
 
-    emotions = {"angry" : 6, "fear" : 5, "sad" : 4, "disgust" : 3, "surprise" : 2, "happy" : 1, "neutral" : 0}
-
-    result = 'neutral'
-
-    if len(result_dict) > 0:
-        for person in result_dict:
-            if emotions[result_dict[person]['emotion']] > emotions[result]:
-                result = result_dict[person]['emotion']
-    return result
+    emotion_ids = result_dict.get('emotion_ids') if result_dict else None
+    if emotion_ids is None or len(emotion_ids) == 0:
+        return 'neutral'
+    return RANK_TO_EMOTION[int(emotion_ids.max())]
 
 def is_negative_emotion(result_dict):
 
-    result = most_dominant_emotion(result_dict)
-
-    if result in ['angry', 'fear', 'sad', 'disgust']:
-        return True
-    else:
-        return False
+    return most_dominant_emotion(result_dict) in NEGATIVE_EMOTIONS
     
 '''
 Type    Confidence-based decision fusion
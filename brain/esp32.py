@@ -1,12 +1,24 @@
-import requests
+import httpx
+from contextlib import asynccontextmanager, nullcontext
 from fastapi import FastAPI
 from pydantic import BaseModel
+import asyncio
+import functools
 import os
 import time
-import threading
 import queue
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Share one keep-alive async client with the ESP32 for the app's lifetime"""
+    app.state.http = httpx.AsyncClient(
+        headers={'Content-Type': 'application/json'},
+        limits=httpx.Limits(max_keepalive_connections=4, max_connections=4)
+    )
+    yield
+    await app.state.http.aclose()
+
+app = FastAPI(lifespan=lifespan)
 ESP32_IP = os.getenv('ESP32_URL')
 
 # Fix URL format - ensure it has http:// prefix
@@ -16,8 +28,9 @@ if ESP32_IP and not ESP32_IP.startswith(('http://', 'https://')):
 print(f"ESP32 URL configured as: {ESP32_IP}")
 
 # Enhanced rate limiting with priority queues
-emotion_request_lock = threading.Lock()
-head_request_lock = threading.Lock()
+# asyncio locks: waiting for a slot yields to other requests instead of blocking the worker
+emotion_request_lock = asyncio.Lock()
+head_request_lock = asyncio.Lock()
 last_emotion_request = 0
 last_head_request = 0
 
@@ -29,6 +42,10 @@ HEAD_MIN_INTERVAL = 1.0       # 1 second between head requests (much longer)
 emotion_queue = queue.Queue(maxsize=5)  # Small queue for emotions
 head_queue = queue.Queue(maxsize=2)     # Very small queue for head tracking
 
+# Monotonic time of the last head tracking success log
+last_head_log = float('-inf')
+HEAD_LOG_INTERVAL = 10
+
 class Sentiment(BaseModel):
     sentiment: str
 
@@ -39,24 +56,24 @@ class HeadPosition(BaseModel):
 def priority_rate_limiter(request_type="emotion"):
     """Enhanced rate limiter with priority for emotions"""
     def decorator(func):
-        def wrapper(*args, **kwargs):
+        # wraps keeps the endpoint signature so FastAPI still parses the request body
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
             global last_emotion_request, last_head_request
             
-            current_time = time.time()
-            
             if request_type == "emotion":
-                with emotion_request_lock:
-                    time_since_last = current_time - last_emotion_request
+                async with emotion_request_lock:
+                    time_since_last = time.time() - last_emotion_request
                     if time_since_last < EMOTION_MIN_INTERVAL:
-                        time.sleep(EMOTION_MIN_INTERVAL - time_since_last)
+                        await asyncio.sleep(EMOTION_MIN_INTERVAL - time_since_last)
                     
-                    result = func(*args, **kwargs)
+                    result = await func(*args, **kwargs)
                     last_emotion_request = time.time()
                     return result
                     
             else:  # head tracking
-                with head_request_lock:
-                    time_since_last = current_time - last_head_request
+                async with head_request_lock:
+                    time_since_last = time.time() - last_head_request
                     if time_since_last < HEAD_MIN_INTERVAL:
                         # For head tracking, skip the request if too recent
                         print(f"Skipping head request (too frequent)")
@@ -65,7 +82,7 @@ def priority_rate_limiter(request_type="emotion"):
                             "message": "Rate limited - skipped"
                         }
                     
-                    result = func(*args, **kwargs)
+                    result = await func(*args, **kwargs)
                     last_head_request = time.time()
                     return result
         
@@ -86,11 +103,10 @@ async def send_emotion(data: Sentiment):
         except:
             pass
         
-        resp = requests.post(
+        resp = await app.state.http.post(
             f"{ESP32_IP}/receive",
             json=data.dict(),
-            timeout=5,  # Longer timeout for emotion requests
-            headers={'Content-Type': 'application/json'}
+            timeout=5  # Longer timeout for emotion requests
         )
         
         if resp.status_code == 200:
@@ -106,7 +122,7 @@ async def send_emotion(data: Sentiment):
                 "status": False
             }
             
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         print("ESP32 emotion request timed out")
         return {
             "error": "ESP32 timeout",
@@ -125,12 +141,15 @@ async def send_emotion_direct(sentiment: str):
     try:
         print(f"DIRECT: Sending emotion to ESP32: {sentiment}")
         
-        resp = requests.post(
-            f"{ESP32_IP}/receive",
-            json={"sentiment": sentiment},
-            timeout=5,
-            headers={'Content-Type': 'application/json'}
-        )
+        # The shared client only exists while the app's lifespan runs; called from
+        # anywhere else, fall back to a one-off client
+        shared = getattr(app.state, "http", None)
+        async with (nullcontext(shared) if shared is not None else httpx.AsyncClient()) as client:
+            resp = await client.post(
+                f"{ESP32_IP}/receive",
+                json={"sentiment": sentiment},
+                timeout=5
+            )
         
         if resp.status_code == 200:
             print(f"Emotion sent successfully: {sentiment}")
@@ -145,7 +164,7 @@ async def send_emotion_direct(sentiment: str):
                 "status": False
             }
             
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         print("ESP32 emotion request timed out")
         return {
             "error": "ESP32 timeout",
@@ -162,6 +181,7 @@ async def send_emotion_direct(sentiment: str):
 @priority_rate_limiter("head")
 async def send_head_position(data: HeadPosition):
     """Send head position to ESP32 - LOWER PRIORITY, heavily rate limited"""
+    global last_head_log
     try:
         # Prepare data - handle both angle and number
         request_data = {}
@@ -173,16 +193,17 @@ async def send_head_position(data: HeadPosition):
         if not request_data:
             return {"error": "No angle or number provided", "status": False}
         
-        resp = requests.post(
+        resp = await app.state.http.post(
             f"{ESP32_IP}/head",
             json=request_data,
-            timeout=1,  # Very short timeout for head requests
-            headers={'Content-Type': 'application/json'}
+            timeout=1  # Very short timeout for head requests
         )
         
         if resp.status_code == 200:
             # Only log successful head tracking occasionally
-            if time.time() % 10 < 1:  # Log every ~10 seconds
+            now = time.monotonic()
+            if now - last_head_log > HEAD_LOG_INTERVAL:  # Log every ~10 seconds
+                last_head_log = now
                 print(f"Head tracking: {request_data}")
             
             return {
@@ -195,7 +216,7 @@ async def send_head_position(data: HeadPosition):
                 "status": False
             }
             
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         # Don't log timeout errors for head tracking (expected during emotion processing)
         return {
             "error": "timeout",
@@ -214,11 +235,10 @@ async def reset_to_default():
     try:
         print("Sending reset to ESP32...")
         
-        resp = requests.post(
+        resp = await app.state.http.post(
             f"{ESP32_IP}/reset",
             json={"action": "reset"},
-            timeout=5,  # Longer timeout for reset
-            headers={'Content-Type': 'application/json'}
+            timeout=5  # Longer timeout for reset
         )
         
         if resp.status_code == 200:
@@ -1,17 +1,35 @@
 import cv2
+import numpy as np
 import os
 
-def apply_median_filter(directory="."):
+def apply_median_filter_array(image: np.ndarray) -> np.ndarray:
+    """Median-blur an in-memory image with kernel size 5"""
+    # For 8-bit images with ksize <= 5 OpenCV already runs a SIMD sorting network
+    # over all channels at once; give it a contiguous buffer so it stays on that path
+    return cv2.medianBlur(np.ascontiguousarray(image), 5)
+
+def apply_median_filter(directory=".", image=None):
+    """File-based wrapper: filter output_image.jpg (or an already-loaded image) into final_image.jpg
+
+    Returns the filtered array so callers do not need to read final_image.jpg back.
+    """
     input_path = os.path.join(directory, "output_image.jpg")
     output_path = os.path.join(directory, "final_image.jpg")
     
-    # Read the image
-    image = cv2.imread(input_path)
+    # Read the image unless the caller already holds it
+    if image is None:
+        image = cv2.imread(input_path)
     if image is None:
         raise FileNotFoundError(f"No image found at {input_path}")
 
     # Apply median blur with kernel size 5
-    filtered_image = cv2.medianBlur(image, 5)
+    filtered_image = apply_median_filter_array(image)
+
+    # Save the final image (single encode)
+    ok, buf = cv2.imencode('.jpg', filtered_image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    if not ok:
+        raise ValueError(f"Could not encode {output_path}")
+    with open(output_path, 'wb') as f:
+        f.write(buf.tobytes())
 
-    # Save the final image
-    cv2.imwrite(output_path, filtered_image)
+    return filtered_image
@@ -1,100 +1,134 @@
+import argparse
 import asyncio
+import logging
+import logging.handlers
 import os
-import requests
-from capture import capture_both_simultaneously
-from sentiment import sentiment_of_conversation
-from agent import output_of_model
-from tts import speak_text
-from analysis import run_parallel_analysis
-from filter import apply_median_filter
-from head_tracker import start_head_tracking_thread, pause_head_tracking, resume_head_tracking, stop_head_tracking
+import queue
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+try:
+    import uvloop  # Optional: faster libuv-based event loop
+except ImportError:
+    uvloop = None
+from capture import capture_frame
+from stt import start_continuous_listening, stop_continuous_listening, pause_listening, resume_listening
+from sentiment import NEGATIVE_SENTIMENTS
+from agent import stream_output_of_model, prime_prompt_prefix
+from tts import get_synthesizer, speak_text
+from analysis import run_face_emotion, run_text_sentiment
+from filter import apply_median_filter_array
+from head_tracker import (start_head_tracking_thread, pause_head_tracking, resume_head_tracking, stop_head_tracking,
+                          wait_for_head_send, tracking_ready)
 from camera_manager import camera_manager
 from emotion import is_negative_emotion  # Import the new function
 import cv2
 
-# ESP32 Configuration - FIXED
-ESP32_URL = os.getenv('ESP32_URL')
-if not ESP32_URL:
-    print("ERROR: ESP32_URL environment variable not set!")
-    print("Set it with: export ESP32_URL='192.168.1.100'")
-    exit(1)
+log = logging.getLogger(__name__)
 
-if not ESP32_URL.startswith('http'):
-    ESP32_URL = f"http://{ESP32_URL}"
+def setup_logging(level=logging.INFO):
+    """Route all logging through a queue: call sites only enqueue, and a background
+    listener thread formats and writes to stdout (alongside the other modules' prints).
+    Returns the listener (stop it on exit)"""
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    # Client libraries log every request at INFO; only their warnings are worth a line
+    for noisy in ("httpx", "httpcore", "huggingface_hub"):
+        logging.getLogger(noisy).setLevel(logging.WARNING)
+    
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(logging.Formatter("%(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream)
+    listener.start()
+    return listener
+
+def parse_args(argv=None):
+    """Read the ESP32 address from --esp32-url (falling back to $ESP32_URL) and
+    normalize it to an http:// URL; exits with a usage error when neither is set"""
+    parser = argparse.ArgumentParser(description="Robot brain conversation pipeline")
+    parser.add_argument("--esp32-url", default=os.getenv('ESP32_URL'),
+                        help="ESP32 address, e.g. 192.168.1.100 (default: $ESP32_URL)")
+    args = parser.parse_args(argv)
+    
+    if not args.esp32_url:
+        parser.error("ESP32 URL not set! Pass --esp32-url or set it with: export ESP32_URL='192.168.1.100'")
+    
+    if not args.esp32_url.startswith('http'):
+        args.esp32_url = f"http://{args.esp32_url}"
+    return args
 
-print(f"ESP32 URL configured as: {ESP32_URL}")
+def retry_delay(attempt: int) -> float:
+    """Exponential backoff between ESP32 retries: 0.2 s, 0.4 s, 0.8 s, ..."""
+    return 0.2 * 2 ** attempt
 
 class ESP32Client:
     """Enhanced ESP32 client with better error handling"""
     
     def __init__(self, base_url: str):
         self.base_url = base_url.rstrip('/')
+        # One keep-alive async client bound to the ESP32: calls skip the TCP handshake,
+        # never block the event loop, and post to short relative paths
+        self._session = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=8.0,
+            limits=httpx.Limits(max_keepalive_connections=4, max_connections=8)
+        )
+        # The ESP32 web server handles one request at a time, so /receive calls take turns
+        self._receive_lock = asyncio.Lock()
+    
+    async def aclose(self):
+        """Close the pooled connections to the ESP32"""
+        await self._session.aclose()
         
-    async def send_emotion(self, sentiment: str, max_retries: int = 3) -> bool:
-        """Send emotion to ESP32 with retry logic"""
+    async def _request(self, method: str, path: str, label: str, *, json=None,
+                       timeout: float = 8.0, max_retries: int = 1, quiet: bool = False) -> bool:
+        """Send one request with retries and exponential backoff; True on HTTP 200"""
         for attempt in range(max_retries):
             try:
-                print(f"Sending emotion: {sentiment} (attempt {attempt + 1}/{max_retries})")
+                if not quiet:
+                    log.info("%s (attempt %s/%s)", label, attempt + 1, max_retries)
                 
-                response = requests.post(
-                    f"{self.base_url}/receive",
-                    json={"sentiment": sentiment},
-                    headers={'Content-Type': 'application/json'},
-                    timeout=8
-                )
+                response = await self._session.request(method, path, json=json, timeout=timeout)
                 
                 if response.status_code == 200:
-                    print(f"Emotion '{sentiment}' sent successfully!")
+                    if not quiet:
+                        log.info("%s: success!", label)
                     return True
-                else:
-                    print(f"ESP32 returned status {response.status_code}: {response.text}")
+                elif not quiet:
+                    log.warning("ESP32 returned status %s: %s", response.status_code, response.text)
                     
-            except requests.exceptions.Timeout:
-                print(f"Emotion request timeout (attempt {attempt + 1})")
-            except requests.exceptions.ConnectionError:
-                print(f"Connection error (attempt {attempt + 1})")
+            except httpx.TimeoutException:
+                if not quiet:
+                    log.warning("%s: timeout (attempt %s)", label, attempt + 1)
+            except httpx.ConnectError:
+                if not quiet:
+                    log.warning("%s: connection error (attempt %s)", label, attempt + 1)
             except Exception as e:
-                print(f"Unexpected error sending emotion: {e}")
+                if not quiet:
+                    log.warning("%s: unexpected error: %s", label, e)
             
             if attempt < max_retries - 1:
-                await asyncio.sleep(1)
+                await asyncio.sleep(retry_delay(attempt))
         
-        print(f"Failed to send emotion '{sentiment}' after {max_retries} attempts")
+        if not quiet:
+            log.warning("%s: failed after %s attempts", label, max_retries)
         return False
+        
+    async def send_emotion(self, sentiment: str, max_retries: int = 3) -> bool:
+        """Send emotion to ESP32 with retry logic"""
+        async with self._receive_lock:
+            return await self._request("POST", "/receive", f"Sending emotion '{sentiment}'",
+                                       json={"sentiment": sentiment}, max_retries=max_retries)
     
     async def reset_robot(self, max_retries: int = 2) -> bool:
         """Reset ESP32 to default state - FIXED TIMING"""
-        for attempt in range(max_retries):
-            try:
-                print(f"Resetting ESP32 (attempt {attempt + 1}/{max_retries})")
-                
-                response = requests.post(
-                    f"{self.base_url}/reset",
-                    timeout=6
-                )
-                
-                if response.status_code == 200:
-                    print("ESP32 reset successful!")
-                    return True
-                else:
-                    print(f"Reset failed with status {response.status_code}")
-                    
-            except Exception as e:
-                print(f"Reset error: {e}")
-            
-            if attempt < max_retries - 1:
-                await asyncio.sleep(1)
-        
-        print("Failed to reset ESP32")
-        return False
+        return await self._request("POST", "/reset", "Resetting ESP32", timeout=6, max_retries=max_retries)
     
     async def test_connection(self) -> bool:
         """Test if ESP32 is reachable"""
-        try:
-            response = requests.get(f"{self.base_url}/ping", timeout=3)
-            return response.status_code == 200
-        except:
-            return False
+        return await self._request("GET", "/ping", "Ping", timeout=3, quiet=True)
 
 def should_process_emotion_response(sentiment: str, emotions_dict: dict) -> tuple[bool, str]:
     """
@@ -104,7 +138,7 @@ def should_process_emotion_response(sentiment: str, emotions_dict: dict) -> tupl
         tuple: (should_process, reason)
     """
     # Step 1: Check if sentiment is negative
-    sentiment_is_negative = sentiment_of_conversation(sentiment=sentiment)
+    sentiment_is_negative = sentiment in NEGATIVE_SENTIMENTS
     
     # Step 2: Check if facial emotions are negative
     emotion_is_negative = is_negative_emotion(emotions_dict)
@@ -118,164 +152,277 @@ def should_process_emotion_response(sentiment: str, emotions_dict: dict) -> tupl
     else:
         return False, "Both sentiment and emotion are positive/neutral"
 
-async def speak_text_async(text: str):
-    """Async wrapper for speak_text that we can await properly"""
-    return await asyncio.to_thread(speak_text, text)
+# Longest startup wait for the head tracking thread to load YOLO
+HEAD_READY_TIMEOUT = 10
+
+# Small warm pool for the blocking stages, capped so head tracking keeps its CPU
+EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="brain")
+
+def run_blocking(fn, *args):
+    """Run fn(*args) on EXECUTOR; returns an awaitable future (already running)"""
+    return asyncio.get_running_loop().run_in_executor(EXECUTOR, fn, *args)
+
+def start_response_stream(text, emotions, frame):
+    """Generate the response on EXECUTOR, handing each finished sentence to the returned
+    asyncio.Queue (None marks the end); returns (queue, producer future)"""
+    loop = asyncio.get_running_loop()
+    sentences = asyncio.Queue()
+    
+    def produce():
+        try:
+            for sentence in stream_output_of_model(text, emotions, frame):
+                loop.call_soon_threadsafe(sentences.put_nowait, sentence)
+        finally:
+            loop.call_soon_threadsafe(sentences.put_nowait, None)
+    
+    return sentences, run_blocking(produce)
+
+# In-flight prompt priming, if any; nothing awaits it
+_priming = None
+
+def start_priming():
+    """Prime the LLM prompt prefix in the background (speculative, so off the critical
+    path); a prime still in flight from an earlier turn is enough"""
+    global _priming
+    if _priming is None or _priming.done():
+        _priming = run_blocking(prime_prompt_prefix)
+
+async def capture_loop(q_raw: asyncio.Queue, mic_free: asyncio.Event, stt_queue: asyncio.Queue):
+    """Stage 1: take the next phrase from continuous STT plus an image, whenever the robot
+    is not about to talk"""
+    conversation_count = 0
+    
+    while True:
+        # Wait until the previous utterance is either dismissed or fully answered; phrases
+        # spoken meanwhile stay queued as the next turns (the recognizer is paused while
+        # the robot talks, so none of them is its own voice)
+        await mic_free.wait()
+        
+        text = await stt_queue.get()
+        mic_free.clear()
+        
+        conversation_count += 1
+        log.info("---  Conversation %s ---", conversation_count)
+        log.info("Captured text: %s...", text[:100])
+        
+        # Image of the speaker, taken the moment their phrase is finalized; this one copy
+        # goes to analysis and to the vision LLM in memory, so both see the same frame
+        try:
+            frame = await run_blocking(capture_frame)
+        except Exception as e:
+            log.error("Error capturing image: %s", e)
+            frame = None
+        
+        await q_raw.put((text, frame))
+
+async def analyze_loop(q_raw: asyncio.Queue, q_decide: asyncio.Queue, mic_free: asyncio.Event):
+    """Stage 2: filter + emotion/sentiment analysis, then decide whether to respond"""
+    while True:
+        text, frame = await q_raw.get()
+        try:
+            # Text sentiment and LLM prompt priming only need the text, so they run
+            # while the image is still being filtered; the decision never waits on priming
+            log.info("Running emotion and sentiment analysis...")
+            start_priming()
+            sentiment_task = asyncio.create_task(run_text_sentiment(text))
+            try:
+                if frame is None:
+                    raise RuntimeError("No camera frame for this conversation")
+                
+                # Apply median filter to image (in memory, no final_image.jpg round trip)
+                log.info("Applying median filter...")
+                filtered = await run_blocking(apply_median_filter_array, frame)
+                
+                emotions, sentiment = await asyncio.gather(
+                    run_blocking(run_face_emotion, filtered),
+                    sentiment_task
+                )
+            except Exception:
+                sentiment_task.cancel()
+                raise
+            log.info("Detected sentiment: %s", sentiment)
+            # Formatting the numpy columns is only paid for when debug logging is on
+            log.debug("Detected emotions: %s", emotions)
+            
+            # ENHANCED LOGIC: Check both sentiment and emotion
+            should_process, reason = should_process_emotion_response(sentiment, emotions)
+            log.info("Decision: %s", reason)
+        except Exception as e:
+            log.error("Error analyzing conversation: %s", e)
+            should_process = False
+        
+        if should_process:
+            await q_decide.put((text, frame, emotions, sentiment, reason))
+        else:
+            log.info("No negative emotion or sentiment detected, continuing normal operation...")
+            mic_free.set()
+
+async def respond_loop(q_decide: asyncio.Queue, esp32_client: ESP32Client, mic_free: asyncio.Event):
+    """Stage 3: emotion gesture, response and speech, with head tracking paused around it"""
+    while True:
+        text, frame, emotions, sentiment, reason = await q_decide.get()
+        try:
+            log.info("Processing emotion response - Reason: %s", reason)
+            
+            # STEP A: Pause head tracking IMMEDIATELY
+            log.info("Pausing head tracking for emotion processing...")
+            pause_head_tracking()
+            # Let an in-flight /head request finish so it cannot cut into the emotion gesture
+            await run_blocking(wait_for_head_send)
+            
+            # STEP B+C: Send emotion data (use sentiment for consistency with ESP32) while
+            # the response is generated; the model needs the emotions, not the ESP32 reply.
+            # Only the reset waits for the send, so ESP32 retries never delay the speech
+            log.info("Sending emotion and generating response...")
+            emotion_task = asyncio.create_task(esp32_client.send_emotion(sentiment))
+            sentences, producer = start_response_stream(text, emotions, frame)
+            try:
+                # STEP D: Speak each sentence as soon as it has streamed in and WAIT for the
+                # last one, with the recognizer off the microphone so the robot does not
+                # hear its own reply as the next turn
+                await run_blocking(pause_listening)
+                log.info("Speaking response...")
+                while (sentence := await sentences.get()) is not None:
+                    log.info("Response: %s", sentence[:100])
+                    await speak_text(sentence)
+                await producer
+            except Exception:
+                emotion_task.cancel()
+                raise
+            log.info("Speech completed!")
+            
+            # STEP E: Let the speaker play out its buffered tail, then listen again and free
+            # the microphone; the next capture starts while the robot resets
+            await asyncio.sleep(0.5)
+            await run_blocking(resume_listening)
+            mic_free.set()
+            
+            # STEP F: Reset AFTER speech (the ESP32 holds the emotion gesture while
+            # speaking); the reset round trip overlaps the settle delay before resuming
+            if not await emotion_task:
+                log.warning("Emotion sending failed, but continuing...")
+            
+            log.info("Sending reset acknowledgment AFTER speech completion...")
+            reset_success, _ = await asyncio.gather(
+                esp32_client.reset_robot(),
+                asyncio.sleep(0.2)
+            )
+            if reset_success:
+                log.info("Reset acknowledgment sent successfully after speech!")
+            else:
+                log.warning("Reset acknowledgment failed, but continuing...")
+            
+            log.info("Resuming head tracking...")
+            resume_head_tracking()
+            
+            log.info("Complete emotion processing sequence finished!")
+            
+        except Exception as e:
+            log.error("Error in emotion response: %s", e)
+            log.info("Ensuring head tracking is resumed after error...")
+            resume_head_tracking()
+            try:
+                await run_blocking(resume_listening)
+            except Exception as e:
+                log.error("Error resuming speech recognition: %s", e)
+            mic_free.set()
 
-async def main():
-    """Main conversation loop with ENHANCED EMOTION-SENTIMENT LOGIC"""
+async def main(esp32_url):
+    """Main conversation pipeline with ENHANCED EMOTION-SENTIMENT LOGIC"""
+    log.info("ESP32 URL configured as: %s", esp32_url)
+    
+    # Any remaining asyncio.to_thread users (analysis helpers) share the same pool
+    asyncio.get_running_loop().set_default_executor(EXECUTOR)
     
     # Initialize ESP32 client
-    esp32_client = ESP32Client(ESP32_URL)
+    esp32_client = ESP32Client(esp32_url)
     
     # Test ESP32 connection at startup
-    print("Testing ESP32 connection...")
+    log.info("Testing ESP32 connection...")
     if not await esp32_client.test_connection():
-        print("Cannot connect to ESP32! Please check:")
-        print("1. ESP32 IP address is correct")
-        print("2. ESP32 is powered on and running")
-        print("3. Both devices are on same WiFi network")
+        log.error("Cannot connect to ESP32! Please check:")
+        log.error("1. ESP32 IP address is correct")
+        log.error("2. ESP32 is powered on and running")
+        log.error("3. Both devices are on same WiFi network")
+        await esp32_client.aclose()
         return
     
-    print("ESP32 connection successful!")
+    log.info("ESP32 connection successful!")
     
     try:
-        print("Starting system with coordinated head tracking...")
+        log.info("Starting system with coordinated head tracking...")
         
         # STEP 1: Start the shared camera manager
-        print("Starting camera manager...")
-        camera_manager.start()
-        await asyncio.sleep(2)
-        print("Camera manager started successfully")
+        log.info("Starting camera manager...")
+        camera_manager.start()  # Returns once the first frame is in (raises otherwise)
+        log.info("Camera manager started successfully")
         
         # STEP 2: Start coordinated head tracking
-        print("Starting head tracking thread...")
+        log.info("Starting head tracking thread...")
         head_thread = start_head_tracking_thread()
-        await asyncio.sleep(1)
-        print("Head tracking started and running in background")
+        # Open the speaker and TTS config off the event loop while tracking loads
+        synthesizer_ready = run_blocking(get_synthesizer)
+        # A first-run TensorRT export can take minutes, so don't hold the conversation for it
+        if await run_blocking(tracking_ready.wait, HEAD_READY_TIMEOUT):
+            log.info("Head tracking started and running in background")
+        else:
+            log.info("Head tracking still loading, continuing in background")
+        await synthesizer_ready
         
-        # STEP 3: Main conversation loop
-        print("Starting main conversation loop...")
-        conversation_count = 0
+        # STEP 3: Conversation pipeline: capture -> analyze -> respond, linked by bounded
+        # queues so one conversation's reset/resume overlaps the next capture
+        log.info("Starting main conversation loop...")
+        q_raw = asyncio.Queue(maxsize=2)
+        q_decide = asyncio.Queue(maxsize=2)
+        mic_free = asyncio.Event()
+        mic_free.set()
         
-        while True:
-            try:
-                conversation_count += 1
-                print(f"\n---  Conversation {conversation_count} ---")
-                
-                # Capture audio and image
-                print("Capturing audio and image...")
-                text = await asyncio.to_thread(capture_both_simultaneously)
-                
-                if not text or text.strip() == "":
-                    print("No text captured, continuing...")
-                    await asyncio.sleep(1)
-                    continue
-                
-                print(f"Captured text: {text[:100]}...")
-                
-                # Apply median filter to image
-                print("Applying median filter...")
-                await asyncio.to_thread(apply_median_filter)
-                
-                # Run emotion and sentiment analysis
-                print("Running emotion and sentiment analysis...")
-                emotions, sentiment = await asyncio.to_thread(
-                    run_parallel_analysis, 'final_image.jpg', text
-                )
-                print(f"Detected sentiment: {sentiment}")
-                print(f"Detected emotions: {emotions}")
-                
-                # ENHANCED LOGIC: Check both sentiment and emotion
-                should_process, reason = should_process_emotion_response(sentiment, emotions)
-                print(f"Decision: {reason}")
-                
-                if should_process:
-                    print(f"Processing emotion response - Reason: {reason}")
-                    
-                    # STEP A: Pause head tracking IMMEDIATELY
-                    print("Pausing head tracking for emotion processing...")
-                    pause_head_tracking()
-                    await asyncio.sleep(0.5)
-                    
-                    # STEP B: Send emotion data (use sentiment for consistency with ESP32)
-                    emotion_sent = await esp32_client.send_emotion(sentiment)
-                    
-                    if not emotion_sent:
-                        print("Emotion sending failed, but continuing...")
-                    
-                    # STEP C: Generate response
-                    print("Generating response...")
-                    response = await asyncio.to_thread(output_of_model, text, emotions)
-                    print(f"Response: {response[:100]}...")
-                    
-                    # STEP D: Speak response and WAIT for completion
-                    print("Speaking response...")
-                    await speak_text_async(response)
-                    print("Speech completed!")
-                    
-                    # STEP E: Wait a moment after speech completes
-                    print("Waiting 2 seconds after speech completion...")
-                    await asyncio.sleep(0.5)
-                    
-                    # STEP F: NOW send reset AFTER speech is completely done
-                    print("Sending reset acknowledgment AFTER speech completion...")
-                    
-                    # STEP F: Wait 3 seconds, THEN send reset AFTER speech is completely done
-                    print("Waiting 1 seconds before sending reset acknowledgment...")
-                    await asyncio.sleep(0.5)
-                    
-                    print("Sending reset acknowledgment AFTER speech completion...")
-                    reset_success = await esp32_client.reset_robot()
-                    if reset_success:
-                        print("Reset acknowledgment sent successfully after speech!")
-                    else:
-                        print("Reset acknowledgment failed, but continuing...")
-                    
-                    # STEP G: Wait before resuming head tracking
-                    print("Waiting 1 more second before resuming head tracking...")
-                    await asyncio.sleep(0.2)
-                    
-                    print("Resuming head tracking...")
-                    resume_head_tracking()
-                    
-                    print("Complete emotion processing sequence finished!\n")
-                
-                else:
-                    print("No negative emotion or sentiment detected, continuing normal operation...")
-                
-                # Small delay before next iteration
-                await asyncio.sleep(0.5)
-                
-            except KeyboardInterrupt:
-                print("\nKeyboard interrupt detected...")
-                break
-            except Exception as e:
-                print(f"Error in main conversation loop: {e}")
-                print("Ensuring head tracking is resumed after error...")
-                resume_head_tracking()
-                await asyncio.sleep(1)
-                continue
+        # Continuous STT pushes each finalized phrase straight onto the pipeline's input
+        stt_queue = asyncio.Queue()
+        await run_blocking(start_continuous_listening, asyncio.get_running_loop(), stt_queue)
+        
+        await asyncio.gather(
+            capture_loop(q_raw, mic_free, stt_queue),
+            analyze_loop(q_raw, q_decide, mic_free),
+            respond_loop(q_decide, esp32_client, mic_free)
+        )
         
     except KeyboardInterrupt:
-        print("\nShutting down system...")
+        log.info("Shutting down system...")
     except Exception as e:
-        print(f"Critical error in main: {e}")
+        log.error("Critical error in main: %s", e)
     finally:
         # STEP 4: Clean shutdown
-        print("Cleaning up...")
+        log.info("Cleaning up...")
         
-        print("Stopping head tracking...")
+        log.info("Stopping head tracking...")
         stop_head_tracking()
         
-        print("Stopping camera manager...")
+        log.info("Stopping camera manager...")
         camera_manager.stop()
         
-        print("Closing OpenCV windows...")
+        await esp32_client.aclose()
+        
+        log.info("Stopping speech recognition...")
+        stop_continuous_listening()
+        
+        # Don't wait for anything still queued on the pool
+        EXECUTOR.shutdown(wait=False, cancel_futures=True)
+        
+        log.info("Closing OpenCV windows...")
         cv2.destroyAllWindows()
         
-        print("Shutdown complete!")
+        log.info("Shutdown complete!")
 
 if __name__ == "__main__":
-    # Run the async main function
-    asyncio.run(main())
\ No newline at end of file
+    # Validate the ESP32 address before anything starts
+    args = parse_args()
+    
+    # Run the async main function (on uvloop when it is installed)
+    listener = setup_logging()
+    loop_factory = uvloop.new_event_loop if uvloop is not None else None
+    try:
+        with asyncio.Runner(loop_factory=loop_factory) as runner:
+            runner.run(main(args.esp32_url))
+    finally:
+        listener.stop()  # Flush whatever is still queued
\ No newline at end of file
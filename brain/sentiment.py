@@ -1,12 +1,12 @@
-import requests
-import json
+import logging
 import os
-import numpy as np
 from dotenv import load_dotenv
-from huggingface_hub import InferenceClient
+from huggingface_hub import AsyncInferenceClient
 
 load_dotenv()
 
+log = logging.getLogger(__name__)
+
 # HuggingFace Endpoint
 API_URL = os.getenv('API_URL')
 
@@ -14,43 +14,46 @@ API_URL = os.getenv('API_URL')
 
 HUGGINGFACEHUB_API_TOKEN = os.getenv("HUGGINGFACEHUB_API_TOKEN")
 
-os.environ["HUGGINGFACEHUB_API_TOKEN"] = HUGGINGFACEHUB_API_TOKEN 
-
-headers = {
-    "Authorization": f"Bearer {HUGGINGFACEHUB_API_TOKEN}",  
-    "Content-Type": "application/json"
-}
+# Zero-shot labels, built once rather than per request
+CANDIDATE_LABELS = ("anger", "fear", "neutral", "sad", "disgust", "happy", "surprise")
 
 def setup_data(text):
     return {
         "inputs": text,
         "parameters": {
-            "candidate_labels": ["anger", "fear", "neutral", "sad", "disgust", "happy", "surprise"],
+            "candidate_labels": CANDIDATE_LABELS,
             "multi_label": True
         }
     }
 
 
-def text_sentiment(data):
-    print('step 3')
-    response = requests.post(API_URL, headers=headers, json=data)
+# Pooled async client for the HuggingFace endpoint, shared by every call on the event loop
+_hf_client = AsyncInferenceClient(model=API_URL, token=HUGGINGFACEHUB_API_TOKEN, timeout=15)
+
+async def text_sentiment(data):
+    log.debug('step 3')
+    parameters = data["parameters"]
+    try:
+        result = await _hf_client.zero_shot_classification(
+            data["inputs"],
+            candidate_labels=parameters["candidate_labels"],
+            multi_label=parameters["multi_label"]
+        )
+    except Exception as e:
+        log.error("Error: %s", e)
+        return 'Error during sentiment: ' + str(e)
+
+    sentiment = max(result, key=lambda element: element.score).label
+    log.info("Sentiment: %s", sentiment)
+    return sentiment
 
-    if response.status_code == 200:
-        responseJson = response.json()
-        sentiment = responseJson['labels'][np.argmax(responseJson['scores'])]
-        print(sentiment)
-        return sentiment
-    else:
-        print("Error:", response.status_code, response.text)
-        return 'Error during sentiment: ' + response.text
 
+# Sentiment labels that trigger an emotion response
+NEGATIVE_SENTIMENTS = frozenset({"anger", "fear", "sad", "disgust"})
 
 def sentiment_of_conversation(sentiment):
 
-    if sentiment in ["anger", "fear", "sad", "disgust"]:
-        return True
-    else:
-        return False
+    return sentiment in NEGATIVE_SENTIMENTS
 
 
 
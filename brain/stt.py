@@ -1,17 +1,33 @@
 import azure.cognitiveservices.speech as speechsdk
+import logging
 import os
+import threading
 from dotenv import load_dotenv
 
 load_dotenv()
+
+log = logging.getLogger(__name__)
+
 api_key = os.getenv('api_key')
 region = os.getenv('region')
 
+# Built on first use and reused; only the recognizer is created per call because it owns the microphone handle
+_speech_config = None
+_speech_config_lock = threading.Lock()
+
+def get_speech_config():
+    """Return the shared speech config, creating it on first call"""
+    global _speech_config
+    with _speech_config_lock:
+        if _speech_config is None:
+            _speech_config = speechsdk.SpeechConfig(subscription=api_key, region=region)
+            _speech_config.speech_recognition_language = 'en-US'
+        return _speech_config
+
 def speak_to_microphone(text_queue):
-    speech_config = speechsdk.SpeechConfig(subscription=api_key, region=region)
-    speech_config.speech_recognition_language = 'en-US'
     audio_config = speechsdk.audio.AudioConfig(use_default_microphone=True)
 
-    recognizer = speechsdk.SpeechRecognizer(speech_config=speech_config, audio_config=audio_config)
+    recognizer = speechsdk.SpeechRecognizer(speech_config=get_speech_config(), audio_config=audio_config)
 
     # Set timeouts
     recognizer.properties.set_property(
@@ -21,15 +37,68 @@ def speak_to_microphone(text_queue):
         speechsdk.PropertyId.SpeechServiceConnection_EndSilenceTimeoutMs, '1000'
     )
 
-    print("Listening to microphone...")
+    log.info("Listening to microphone...")
     result = recognizer.recognize_once_async().get()
 
     if result.reason == speechsdk.ResultReason.RecognizedSpeech:
         text_queue.put(result.text)
-        print(result.text)
+        log.info("Recognized: %s", result.text)
     else:
         text_queue.put("Speech not recognized or error.")
-  
+
+
+# Continuous recognition: one recognizer for the whole session, results pushed to an asyncio.Queue
+_continuous_recognizer = None
+# Cleared while the robot speaks so its own voice never becomes a user phrase
+_accepting_phrases = threading.Event()
+
+def start_continuous_listening(loop, text_queue):
+    """Start listening on the default microphone; each finalized phrase is put on text_queue
+    (an asyncio.Queue owned by loop) as soon as the recognizer emits it"""
+    global _continuous_recognizer
+    audio_config = speechsdk.audio.AudioConfig(use_default_microphone=True)
+    recognizer = speechsdk.SpeechRecognizer(speech_config=get_speech_config(), audio_config=audio_config)
+
+    # Same 1 s end-of-phrase silence as the single-shot path
+    recognizer.properties.set_property(
+        speechsdk.PropertyId.Speech_SegmentationSilenceTimeoutMs, '1000'
+    )
+
+    def on_recognized(evt):
+        if not _accepting_phrases.is_set():
+            return
+        if evt.result.reason == speechsdk.ResultReason.RecognizedSpeech and evt.result.text:
+            log.info("Recognized: %s", evt.result.text)
+            loop.call_soon_threadsafe(text_queue.put_nowait, evt.result.text)
+
+    recognizer.recognized.connect(on_recognized)
+    recognizer.start_continuous_recognition_async().get()
+    _continuous_recognizer = recognizer
+    _accepting_phrases.set()
+    log.info("Listening to microphone...")
+
+def pause_listening():
+    """Take the recognizer off the microphone (e.g. while the robot talks); a phrase
+    finalized during the stop is dropped as well. Blocking"""
+    _accepting_phrases.clear()
+    if _continuous_recognizer is not None:
+        _continuous_recognizer.stop_continuous_recognition_async().get()
+
+def resume_listening():
+    """Put a paused recognizer back on the microphone; no-op if it is already listening. Blocking"""
+    if _continuous_recognizer is None or _accepting_phrases.is_set():
+        return
+    _continuous_recognizer.start_continuous_recognition_async().get()
+    _accepting_phrases.set()
+    log.info("Listening to microphone...")
+
+def stop_continuous_listening():
+    """Stop the continuous recognizer started by start_continuous_listening"""
+    global _continuous_recognizer
+    _accepting_phrases.clear()
+    if _continuous_recognizer is not None:
+        _continuous_recognizer.stop_continuous_recognition_async().get()
+        _continuous_recognizer = None
 
 '''
 
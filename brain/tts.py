@@ -1,28 +1,69 @@
 import os
+import asyncio
+import threading
 import azure.cognitiveservices.speech as speechsdk
 from dotenv import load_dotenv
 
 load_dotenv()
 
-def speak_text(text):
-    api_key = os.getenv('api_key')
-    region = os.getenv('region')
+api_key = os.getenv('api_key')
+region = os.getenv('region')
 
-    # Set up config
-    speech_config = speechsdk.SpeechConfig(subscription=api_key, region=region)
-    speech_config.speech_synthesis_voice_name = "en-US-BrianMultilingualNeural"
+# Built on first use and reused for every utterance (config, speaker handle and service connection)
+_synthesizer = None
+_synthesizer_lock = threading.Lock()
 
-    # Output to default speaker
-    audio_config = speechsdk.audio.AudioOutputConfig(use_default_speaker=True)
+# (loop, future) of the utterance being spoken; resolved from the SDK's callback thread
+_pending_speech = None
 
-    # Create synthesizer
-    synthesizer = speechsdk.SpeechSynthesizer(speech_config, audio_config)
+def _resolve(future, result):
+    if not future.done():
+        future.set_result(result)
+
+def _on_synthesis_done(evt):
+    """SDK callback for completed or canceled synthesis: hand the result to the waiting coroutine"""
+    pending = _pending_speech
+    if pending is not None:
+        loop, future = pending
+        loop.call_soon_threadsafe(_resolve, future, evt.result)
+
+def get_synthesizer():
+    """Return the shared speech synthesizer, creating it on first call"""
+    global _synthesizer
+    with _synthesizer_lock:
+        if _synthesizer is None:
+            # Set up config
+            speech_config = speechsdk.SpeechConfig(subscription=api_key, region=region)
+            speech_config.speech_synthesis_voice_name = "en-US-BrianMultilingualNeural"
+
+            # Output to default speaker
+            audio_config = speechsdk.audio.AudioOutputConfig(use_default_speaker=True)
+
+            # Create synthesizer
+            _synthesizer = speechsdk.SpeechSynthesizer(speech_config, audio_config)
+            _synthesizer.synthesis_completed.connect(_on_synthesis_done)
+            _synthesizer.synthesis_canceled.connect(_on_synthesis_done)
+        return _synthesizer
+
+async def speak_text(text):
+    """Speak text on the default speaker; awaits the SDK's completion event instead of
+    parking a thread in .get() for the whole utterance (one utterance at a time)"""
+    global _pending_speech
+    # Normally built at startup; if not, build it in a thread so the loop is not blocked
+    synthesizer = _synthesizer or await asyncio.to_thread(get_synthesizer)
+
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    _pending_speech = (loop, future)
 
     # Strip and speak text
     text = text.strip()
-    result = synthesizer.speak_text_async(text).get()
+    try:
+        speech = synthesizer.speak_text_async(text)  # Keep the SDK future alive until the event fires
+        result = await future
+    finally:
+        _pending_speech = None
 
     # Optional: check if it succeeded
     if result.reason != speechsdk.ResultReason.SynthesizingAudioCompleted:
         print("TTS failed:", result.reason)
-